@@ -192,6 +192,8 @@ EMAIL_HOST_PASSWORD = env.str("EMAIL_HOST_PASSWORD", default="")
 EMAIL_HOST = env.str("EMAIL_HOST", default="mailcatcher")
 EMAIL_PORT = env.int("EMAIL_PORT", default=1025)
 EMAIL_FOLDER = env.int("EMAIL_FOLDER", default="INBOX")
+# Log out the IMAP connection of a web worker after this many idle seconds
+EMAIL_IMAP_IDLE_TIMEOUT = env.int("EMAIL_IMAP_IDLE_TIMEOUT", default=60)
 
 # Dateparser uses "m" as minutes. Because of that
 # you'll have to use "3months@rmd.io" instead of "3m@rmd.io"
@@ -240,10 +242,10 @@ BLOCK_DELAYS = {
 }
 
 CALENDAR_STRIP_PREFIXES = (
-    r"^Re:\s*",
-    r"^Ant:\s*",
-    r"^Fwd:\s*",
-    r"^Wg:\s*",
+    "Re:",
+    "Ant:",
+    "Fwd:",
+    "Wg:",
 )
 
 DATEPARSER_SETTINGS = {
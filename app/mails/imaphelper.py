@@ -2,6 +2,7 @@ import datetime
 import email
 import imaplib
 import re
+import threading
 from logging import getLogger
 
 import pytz
@@ -9,6 +10,10 @@ from django.conf import settings
 
 log = getLogger()
 
+_shared_conn = None
+_shared_conn_timer = None
+_shared_conn_lock = threading.Lock()
+
 
 def get_connection():
     """Gets an IMAP connection
@@ -22,6 +27,96 @@ def get_connection():
     return imap_conn
 
 
+def _get_shared_connection():
+    """Gets the process wide IMAP connection, connecting if needed
+
+    :rtype  imaplib.IMAP4_SSL
+    """
+    global _shared_conn
+
+    if _shared_conn is None:
+        _shared_conn = get_connection()
+
+    return _shared_conn
+
+
+def _close_shared_connection():
+    """Closes the process wide IMAP connection"""
+    global _shared_conn
+
+    if _shared_conn is None:
+        return
+
+    try:
+        _shared_conn.logout()
+    except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError):
+        pass
+    _shared_conn = None
+
+
+def _close_idle_shared_connection():
+    """Logs out the process wide IMAP connection once it went idle
+
+    Every uwsgi worker has its own connection, so idle ones are given back
+    to not run into the server's connection limit per mailbox.
+    """
+    with _shared_conn_lock:
+        _close_shared_connection()
+
+
+def with_shared_connection(func, *args, **kwargs):
+    """Runs a function with the process wide IMAP connection
+
+    The connection is kept open between calls to save the TLS handshake and
+    login, and logged out after EMAIL_IMAP_IDLE_TIMEOUT seconds without use.
+    If the server dropped it, the function is retried once with a new
+    connection, so it has to be safe to run twice.
+
+    :param  func: function which gets the connection as first argument
+    :type   func: callable
+    """
+    global _shared_conn_timer
+
+    with _shared_conn_lock:
+        if _shared_conn_timer is not None:
+            _shared_conn_timer.cancel()
+
+        try:
+            return func(_get_shared_connection(), *args, **kwargs)
+        except (imaplib.IMAP4.abort, OSError):
+            log.info("IMAP connection was dropped, reconnecting")
+            _close_shared_connection()
+            return func(_get_shared_connection(), *args, **kwargs)
+        finally:
+            _shared_conn_timer = threading.Timer(
+                settings.EMAIL_IMAP_IDLE_TIMEOUT, _close_idle_shared_connection
+            )
+            _shared_conn_timer.daemon = True
+            _shared_conn_timer.start()
+
+
+def delete_by_dbids(imap_conn, dbids):
+    """Deletes and expunges the IMAP mails of the given database ids
+
+    :param  imap_conn: the IMAP connection to delete the mails from
+    :type   imap_conn: imaplib.IMAP4_SSL
+    :param  dbids:     database ids of the mails
+    :type   dbids:     list
+    """
+    imapuids = []
+    for dbid in dbids:
+        results, data = imap_conn.uid(
+            "search", None, '(KEYWORD "MAILDELAY-%d")' % int(dbid)
+        )
+        imapuids.extend(uid.decode() for uid in data[0].split())
+
+    if not imapuids:
+        return
+
+    imap_conn.uid("store", ",".join(imapuids), "+FLAGS", "(\\Deleted)")
+    imap_conn.expunge()
+
+
 def get_unflagged(imap_conn):
     """Gets all unflagged mails of an IMAP connection
 
@@ -3,6 +3,7 @@ import logging
 import re
 
 from django.contrib.auth.models import User
+from django.core.mail.backends.base import BaseEmailBackend
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from mails import imaphelper, tools
@@ -11,10 +12,32 @@ from mails.models import Due, ImportLog, Mail, Recipient, Statistic
 logger = logging.getLogger("mails")
 
 
+class LazyMailConnection(BaseEmailBackend):
+    """Shares one SMTP session for all notifications of an import run
+
+    The session is only opened when the first notification is sent, so runs
+    without any do not connect at all.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LazyMailConnection, self).__init__(*args, **kwargs)
+        self.backend = None
+
+    def send_messages(self, email_messages):
+        self.backend = tools.get_open_mail_connection(self.backend)
+        return self.backend.send_messages(email_messages)
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+
+
 class Command(BaseCommand):
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
         self.imported_mail_ids = []
+        self.mail_conn = LazyMailConnection()
 
     def import_mail(self, message):
 
@@ -45,12 +68,16 @@ class Command(BaseCommand):
         except:
             message.delete()
             logger.error("Mail from %s deleted: User not registered" % sender)
-            tools.send_registration_mail(sender)
+            tools.send_registration_mail(sender, connection=self.mail_conn)
 
             return
 
         if message_deleted_due_to_invalid_keys(
-            keys=keys, sender=sender, message=message, account=account
+            keys=keys,
+            sender=sender,
+            message=message,
+            account=account,
+            connection=self.mail_conn,
         ):
             return
 
@@ -91,19 +118,24 @@ class Command(BaseCommand):
         imap_conn = imaphelper.get_connection()
         messages = imaphelper.get_unflagged(imap_conn)
 
-        for message in messages:
-            self.import_mail(message)
+        try:
+            for message in messages:
+                self.import_mail(message)
+        finally:
+            self.mail_conn.close()
 
         imap_conn.expunge()
         logger.info("Importing new emails finished")
 
 
-def message_deleted_due_to_invalid_keys(keys, sender, message, account):
+def message_deleted_due_to_invalid_keys(
+    keys, sender, message, account, connection=None
+):
     if account.anti_spam:
         if not len(keys):
             message.delete()
             logger.error("Mail from %s deleted: No key" % sender)
-            tools.send_wrong_recipient_mail(sender)
+            tools.send_wrong_recipient_mail(sender, connection=connection)
             return True
         elif not any(key == account.key for key in keys):
             message.delete()
@@ -1,5 +1,6 @@
 import chardet
 import logging
+import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -8,7 +9,7 @@ from django.core.mail import EmailMessage
 from django.core.management.base import BaseCommand
 from django.template.loader import get_template
 from django.utils import timezone
-from mails import imaphelper
+from mails import imaphelper, tools
 from mails.models import Due, Statistic
 
 logger = logging.getLogger("mails")
@@ -16,12 +17,47 @@ logger = logging.getLogger("mails")
 
 class Command(BaseCommand):
     def handle(self, *args, **kwargs):
-        dues = Due.objects.filter(due__lte=timezone.now())
-
+        dues = Due.objects.filter(due__lte=timezone.now()).select_related("mail__user")
+        if not dues:
+            return
+
+        # One IMAP and SMTP session for the whole run instead of one per due
+        imap_conn = imaphelper.get_connection()
+        self.mail_conn = None
+        try:
+            self.mail_conn = tools.get_open_mail_connection(None)
+            self.send_dues(dues, imap_conn)
+        finally:
+            if self.mail_conn is not None:
+                self.mail_conn.close()
+            imap_conn.expunge()
+            imap_conn.logout()
+
+    def send_due_mail(self, message, mail, text):
+        """Sends the reminder, reconnecting once if the SMTP session was dropped
+
+        Django's backend does not reopen a connection it still holds, so
+        without closing it every following due would fail as well.
+        """
+        try:
+            send_email_with_attachments(
+                message=message, mail=mail, text=text, connection=self.mail_conn
+            )
+        except (smtplib.SMTPException, OSError):
+            logger.info("Mail connection failed, reconnecting")
+            try:
+                self.mail_conn.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.mail_conn = tools.get_open_mail_connection(self.mail_conn)
+            send_email_with_attachments(
+                message=message, mail=mail, text=text, connection=self.mail_conn
+            )
+
+    def send_dues(self, dues, imap_conn):
         for due in dues:
             mail = due.mail
 
-            imap_conn = imaphelper.get_connection()
             try:
                 message = imaphelper.IMAPMessage.from_dbid(mail.id, imap_conn)
             except IndexError:
@@ -37,7 +73,7 @@ class Command(BaseCommand):
             text = tpl.render({"recipients": recipients})
 
             try:
-                send_email_with_attachments(message=message, mail=mail, text=text)
+                self.send_due_mail(message, mail, text)
             except Exception as exc:
                 message.delete()
                 logger.error("Failed to write new header")
@@ -77,7 +113,7 @@ def attach_MIMEText_to_mulitpart_messages(message, text):
     return msg
 
 
-def send_email_with_attachments(message, mail, text):
+def send_email_with_attachments(message, mail, text, connection=None):
     for i in message.msg.walk():
         if i.get_content_maintype() == "text":
             content = i.get_payload(decode=True)
@@ -97,6 +133,7 @@ def send_email_with_attachments(message, mail, text):
         autodecode(content) + text,
         settings.EMAIL_HOST_USER,
         [mail.user.email],
+        connection=connection,
     )
     for attachment in attachments:
         email.attach(
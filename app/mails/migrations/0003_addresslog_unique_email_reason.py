@@ -0,0 +1,31 @@
+# Generated by Django 3.0.7 on 2026-10-15 04:38
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def delete_duplicate_address_logs(apps, schema_editor):
+    AddressLog = apps.get_model("mails", "AddressLog")
+    latest_ids = (
+        AddressLog.objects.values("email", "reason")
+        .annotate(latest_id=Max("id"))
+        .values_list("latest_id", flat=True)
+    )
+    AddressLog.objects.exclude(id__in=list(latest_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mails", "0002_auto_20201027_1325"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_address_logs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="addresslog",
+            constraint=models.UniqueConstraint(
+                fields=("email", "reason"), name="unique_addresslog_email_reason"
+            ),
+        ),
+    ]
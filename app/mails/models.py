@@ -14,10 +14,8 @@ class Mail(models.Model):
         return cls.objects.filter(user__in=users)
 
     def next_due(self):
-        next_due = self.dues.order_by("due").first()
-        if next_due is None:
-            return None
-        return next_due.due
+        # Iterate over all dues so a prefetched relation is used as is
+        return min((due.due for due in self.dues.all()), default=None)
 
 
 class Account(models.Model):
@@ -62,6 +60,13 @@ class AddressLog(models.Model):
     attempt = models.IntegerField()
     date = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["email", "reason"], name="unique_addresslog_email_reason"
+            )
+        ]
+
 
 class ImportLog(models.Model):
     date = models.DateTimeField(auto_now=True)
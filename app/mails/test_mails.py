@@ -1,11 +1,37 @@
 import base64
 import datetime
 import hashlib
+import imaplib
+import importlib
+import smtplib
 
+import dateparser
 import pytest
+from django.conf import settings as django_settings
+from django.contrib.auth.models import User
 from django.core.mail import send_mail
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.utils.encoding import smart_bytes
-from mails import tools
+from mails import imaphelper, tools
+from mails.models import Account, AddressLog, Due, Mail, Recipient, UserProfile
+
+
+@pytest.fixture
+def account_user(db):
+    user = User.objects.create_user("testuser", "test@te.st", "password")
+    account = Account.objects.create(key=tools.generate_key())
+    UserProfile.objects.create(user=user, account=account)
+    return user
+
+
+def create_mail(user, subject="Test"):
+    mail = Mail.objects.create(user=user, subject=subject, sent=timezone.now())
+    Due.objects.create(mail=mail, due=timezone.now() + datetime.timedelta(days=1))
+    Recipient.objects.create(mail=mail, email="1d@rmd.io")
+    return mail
 
 
 @pytest.mark.parametrize(
@@ -20,6 +46,7 @@ from mails import tools
         ("/password_change/", 302),
         ("/mails/", 302),
         ("/mails/delete/", 302),
+        ("/mails/edit/1/", 302),
         ("/admin/", 302),
         ("/statistic/", 302),
         ("/settings/", 302),
@@ -40,6 +67,7 @@ def test_page_status(url, status_code, client):
         "/password_change/",
         "/mails/",
         "/mails/delete/",
+        "/mails/edit/1/",
         "/statistic/",
         "/settings/",
         "/user/add/",
@@ -69,6 +97,11 @@ def test_type_of_key_generator_output():
     assert type(key) is str
 
 
+def test_generated_key_matches_key_address():
+    key = tools.generate_key()
+    assert tools.get_key_from_email_address("1d.%s@rmd.io" % key) == key
+
+
 def test_correct_get_reminder_date_from_emai_address():
     delay = tools.get_reminder_date_from_email_address("2w@rmd.io")
     now = datetime.datetime.now()
@@ -76,6 +109,21 @@ def test_correct_get_reminder_date_from_emai_address():
     assert delay.date() == expected.date()
 
 
+@pytest.mark.parametrize("delay", ["1d", "11d", "2w", "1month", "11months"])
+def test_parse_delay_matches_dateparser(delay):
+    expected = dateparser.parse(delay, settings=django_settings.DATEPARSER_SETTINGS)
+    parsed = tools.parse_delay(delay)
+    # Depending on the installed tzlocal, dateparser may ignore DST changes
+    assert abs(parsed - expected) < datetime.timedelta(hours=1, seconds=5)
+
+
+@pytest.mark.parametrize("delay", ["4000000d", "99999999999999999999d"])
+def test_out_of_range_delay_is_invalid(delay):
+    assert tools.parse_delay(delay) is None
+    with pytest.raises(Exception, match="Invalid delay"):
+        tools.get_reminder_date_from_email_address("%s@rmd.io" % delay)
+
+
 def test_wrong_get_reminder_date_from_email_address():
     email = "29.02.2001t@rmd.io"
     with pytest.raises(Exception):
@@ -106,3 +154,439 @@ def test_get_delay_addresses_from_recipients():
     delay_addresses = tools.get_delay_addresses_from_recipients(recipients)
     expected = ["1d@rmd.io", "2d.123asd456x@rmd.io", "3d.123@rmd.io"]
     assert delay_addresses == expected
+
+
+@pytest.mark.parametrize(
+    "subject, expected",
+    [
+        ("Meeting", "Meeting"),
+        ("Re: Meeting", "Meeting"),
+        ("Re: Fwd: RE:Wg: Meeting", "Meeting"),
+        ("Meeting Re: notes", "Meeting Re: notes"),
+    ],
+)
+def test_calendar_clean_subject(subject, expected):
+    assert tools.calendar_clean_subject(subject) == expected
+
+
+def test_mail_view_query_count_independent_of_mails(account_user, client):
+    client.force_login(account_user)
+    create_mail(account_user)
+    with CaptureQueriesContext(connection) as single:
+        client.get("/mails/")
+
+    for i in range(5):
+        create_mail(account_user)
+    with CaptureQueriesContext(connection) as multiple:
+        response = client.get("/mails/")
+
+    assert len(response.context["mails"]) == 6
+    assert len(multiple) == len(single)
+    mail_query = next(q["sql"] for q in multiple if 'FROM "mails_mail"' in q["sql"])
+    assert '"auth_user"."password"' not in mail_query
+
+
+def test_mail_view_orders_by_next_due(account_user, client):
+    client.force_login(account_user)
+    later = create_mail(account_user, subject="later")
+    sooner = create_mail(account_user, subject="sooner")
+    sooner.dues.update(due=timezone.now() + datetime.timedelta(hours=1))
+    without_due = Mail.objects.create(
+        user=account_user, subject="none", sent=timezone.now()
+    )
+
+    response = client.get("/mails/")
+
+    assert list(response.context["mails"]) == [sooner, later, without_due]
+
+
+def test_get_all_users_of_account_fetches_accounts(
+    account_user, django_assert_num_queries
+):
+    account = account_user.get_account()
+    other = User.objects.create_user("otheruser", "other@te.st", "password")
+    UserProfile.objects.create(user=other, account=account)
+
+    # A freshly loaded user, as in a request, without a cached profile
+    user = User.objects.get(pk=account_user.pk)
+    with django_assert_num_queries(1):
+        users = tools.get_all_users_of_account(user)
+        accounts = [u.get_account() for u in users]
+
+    assert accounts == [account, account]
+
+
+def test_create_additional_user_sends_activation_key(account_user, mailoutbox):
+    tools.create_additional_user(email="new@te.st", user=account_user)
+
+    new_user = User.objects.get(email="new@te.st")
+    key = base64.urlsafe_b64encode(new_user.username.encode("utf-8")).decode("utf-8")
+    assert new_user.get_account() == account_user.get_account()
+    assert not new_user.is_active
+    assert len(mailoutbox) == 1
+    assert key in mailoutbox[0].body
+
+
+def test_send_registration_mail_only_once(db, mailoutbox):
+    tools.send_registration_mail("unknown@te.st")
+    tools.send_registration_mail("unknown@te.st")
+
+    assert len(mailoutbox) == 1
+    assert AddressLog.objects.filter(email="unknown@te.st", reason="NREG").count() == 1
+
+
+def test_send_registration_mail_retried_after_failed_send(db, mailoutbox, monkeypatch):
+    def fail_send(self, fail_silently=False):
+        raise smtplib.SMTPServerDisconnected()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(tools.EmailMessage, "send", fail_send)
+        with pytest.raises(smtplib.SMTPServerDisconnected):
+            tools.send_registration_mail("unknown@te.st")
+
+    assert not AddressLog.objects.filter(email="unknown@te.st").exists()
+
+    tools.send_registration_mail("unknown@te.st")
+
+    assert len(mailoutbox) == 1
+
+
+def test_delete_log_entries(db):
+    AddressLog.objects.create(email="test@te.st", reason="NREG", attempt=1)
+    AddressLog.objects.create(email="test@te.st", reason="SPAM", attempt=0)
+
+    tools.delete_log_entries("test@te.st")
+    tools.delete_log_entries("test@te.st")
+
+    assert not AddressLog.objects.filter(email="test@te.st").exists()
+
+
+def test_send_activation_mail_increments_attempt(db, mailoutbox, settings):
+    log_entry = AddressLog.objects.create(email="test@te.st", reason="SPAM", attempt=1)
+    AddressLog.objects.filter(pk=log_entry.pk).update(
+        date=timezone.now() + datetime.timedelta(minutes=5)
+    )
+
+    before = timezone.now()
+    tools.send_activation_mail(key="key", recipient="test@te.st")
+
+    log_entry.refresh_from_db()
+    assert len(mailoutbox) == 1
+    assert log_entry.attempt == 2
+    assert log_entry.date >= before + settings.BLOCK_DELAYS[2]
+
+
+def test_send_activation_mail_blocked(db, mailoutbox):
+    log_entry = AddressLog.objects.create(email="test@te.st", reason="SPAM", attempt=6)
+    AddressLog.objects.filter(pk=log_entry.pk).update(
+        date=timezone.now() + datetime.timedelta(days=7)
+    )
+
+    tools.send_activation_mail(key="key", recipient="test@te.st")
+
+    log_entry.refresh_from_db()
+    assert len(mailoutbox) == 0
+    assert log_entry.attempt == 6
+
+
+def test_send_activation_mail_logs_fresh_recipients(db, mailoutbox):
+    tools.send_activation_mail(key="key", recipient="first@te.st")
+    tools.send_activation_mail(key="key", recipient="second@te.st")
+
+    assert len(mailoutbox) == 2
+    assert list(
+        AddressLog.objects.order_by("email").values_list("email", "reason", "attempt")
+    ) == [("first@te.st", "SPAM", 0), ("second@te.st", "SPAM", 0)]
+
+
+def test_send_connection_mail_logs_fresh_recipients(account_user, mailoutbox):
+    account = account_user.get_account()
+    tools.send_connection_mail(key="key", recipient="first@te.st", account=account)
+    tools.send_connection_mail(key="key", recipient="second@te.st", account=account)
+
+    assert len(mailoutbox) == 2
+    assert list(
+        AddressLog.objects.order_by("email").values_list("email", "reason", "attempt")
+    ) == [("first@te.st", "SPAM", 0), ("second@te.st", "SPAM", 0)]
+
+
+def test_send_activation_mail_rolled_back_after_failed_send(db, monkeypatch):
+    log_entry = AddressLog.objects.create(email="test@te.st", reason="SPAM", attempt=1)
+    AddressLog.objects.filter(pk=log_entry.pk).update(
+        date=timezone.now() + datetime.timedelta(minutes=5)
+    )
+
+    def fail_send(self, fail_silently=False):
+        raise smtplib.SMTPServerDisconnected()
+
+    monkeypatch.setattr(tools.EmailMessage, "send", fail_send)
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        tools.send_activation_mail(key="key", recipient="test@te.st")
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        tools.send_activation_mail(key="key", recipient="new@te.st")
+
+    log_entry.refresh_from_db()
+    assert log_entry.attempt == 1
+    assert not AddressLog.objects.filter(email="new@te.st").exists()
+
+
+class FakeIMAPConnection:
+    def __init__(self):
+        self.commands = []
+
+    def uid(self, *args):
+        self.commands.append(args)
+        if args[0] == "search":
+            return "OK", [b"7 8"]
+        return "OK", [None]
+
+    def expunge(self):
+        self.commands.append(("expunge",))
+
+    def logout(self):
+        self.commands.append(("logout",))
+
+
+def test_delete_by_dbids():
+    imap_conn = FakeIMAPConnection()
+    imaphelper.delete_by_dbids(imap_conn, [1])
+    assert imap_conn.commands[1:] == [
+        ("store", "7,8", "+FLAGS", "(\\Deleted)"),
+        ("expunge",),
+    ]
+
+
+def test_shared_connection_is_reused(monkeypatch):
+    connections = []
+
+    def get_connection():
+        connections.append(FakeIMAPConnection())
+        return connections[-1]
+
+    def fail_once(imap_conn):
+        if len(connections) == 1:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        return imap_conn
+
+    monkeypatch.setattr(imaphelper, "get_connection", get_connection)
+    monkeypatch.setattr(imaphelper, "_shared_conn", None)
+
+    first = imaphelper.with_shared_connection(lambda imap_conn: imap_conn)
+    second = imaphelper.with_shared_connection(lambda imap_conn: imap_conn)
+    assert first is second
+
+    monkeypatch.setattr(imaphelper, "_shared_conn", None)
+    connections.clear()
+    assert imaphelper.with_shared_connection(fail_once) is connections[1]
+
+
+def test_shared_connection_connect_fails(monkeypatch):
+    def get_connection():
+        raise ConnectionRefusedError(111, "Connection refused")
+
+    monkeypatch.setattr(imaphelper, "get_connection", get_connection)
+    monkeypatch.setattr(imaphelper, "_shared_conn", None)
+
+    with pytest.raises(ConnectionRefusedError):
+        imaphelper.with_shared_connection(imaphelper.delete_by_dbids, [1])
+
+
+def test_shared_connection_logged_out_when_idle(monkeypatch, settings):
+    imap_conn = FakeIMAPConnection()
+    monkeypatch.setattr(imaphelper, "get_connection", lambda: imap_conn)
+    monkeypatch.setattr(imaphelper, "_shared_conn", None)
+    settings.EMAIL_IMAP_IDLE_TIMEOUT = 0.01
+
+    imaphelper.with_shared_connection(lambda imap_conn: None)
+    imaphelper._shared_conn_timer.join(1)
+
+    assert imap_conn.commands == [("logout",)]
+    assert imaphelper._shared_conn is None
+
+
+def test_download_calendar_view(account_user, client, django_assert_num_queries):
+    create_mail(account_user, subject="Re: Fwd: Meeting")
+    mail = create_mail(account_user, subject="Re: Lunch")
+    Due.objects.create(mail=mail, due=timezone.now() + datetime.timedelta(days=2))
+    secret = base64.urlsafe_b64encode(account_user.username.encode("utf-8")).decode(
+        "utf-8"
+    )
+
+    with django_assert_num_queries(3):
+        response = client.get("/calendar/%s/" % secret)
+
+    content = response.content.decode("utf-8")
+    assert content.count("SUMMARY:Meeting [rmd.io]") == 1
+    assert content.count("SUMMARY:Lunch [rmd.io]") == 2
+
+
+def test_sendmail_without_dues_does_not_connect(db, monkeypatch):
+    def get_connection():
+        raise AssertionError("IMAP connection opened without dues")
+
+    monkeypatch.setattr(imaphelper, "get_connection", get_connection)
+    call_command("sendmail")
+
+
+def test_mail_edit_view_of_foreign_mail(account_user, client):
+    other = User.objects.create_user("otheruser", "other@te.st", "password")
+    UserProfile.objects.create(
+        user=other, account=Account.objects.create(key=tools.generate_key())
+    )
+    mail = create_mail(other)
+    client.force_login(account_user)
+
+    response = client.get("/mails/edit/%d/" % mail.id)
+
+    assert response.status_code == 404
+
+
+def test_mail_update_view_deletes_removed_dues(account_user, client):
+    mail = create_mail(account_user)
+    kept = mail.dues.get()
+    Due.objects.create(mail=mail, due=timezone.now())
+    client.force_login(account_user)
+
+    client.post(
+        "/mails/update/",
+        {"mail_id": mail.id, "due-%d" % kept.id: "2030-01-01 10:00"},
+    )
+
+    assert list(mail.dues.all()) == [kept]
+    assert mail.dues.get().due.year == 2030
+
+
+def test_my_mails_in_one_query(account_user, django_assert_num_queries):
+    mail = create_mail(account_user)
+    user = User.objects.get(pk=account_user.pk)
+
+    with django_assert_num_queries(1):
+        assert list(Mail.my_mails(user)) == [mail]
+
+
+def test_wrong_key_mail_uses_given_connection(account_user, mailoutbox):
+    import_command = importlib.import_module("mails.management.commands.import")
+    account = account_user.get_account()
+    account.anti_spam = True
+    connection = import_command.LazyMailConnection()
+
+    class FakeMessage:
+        def delete(self):
+            pass
+
+    for sender in ["a@te.st", "b@te.st"]:
+        assert import_command.message_deleted_due_to_invalid_keys(
+            keys=[],
+            sender=sender,
+            message=FakeMessage(),
+            account=account,
+            connection=connection,
+        )
+
+    assert len(mailoutbox) == 2
+    assert [mail.connection for mail in mailoutbox] == [connection, connection]
+
+
+def test_get_delay_addresses_from_recipients_ignores_keyed_non_delays():
+    recipients = [
+        {"email": "hello.0123456789@rmd.io"},
+        {"email": "2w.0123456789@rmd.io"},
+    ]
+    delay_addresses = tools.get_delay_addresses_from_recipients(recipients)
+    assert delay_addresses == ["2w.0123456789@rmd.io"]
+
+
+@pytest.mark.parametrize(
+    "email, key",
+    [
+        ("2d.0123456789@rmd.io", "0123456789"),
+        ("2d.abcdefghij@rmd.io", "abcdefghij"),
+        ("2d@rmd.io", None),
+        ("2d.ABCDEFGHIJ@rmd.io", None),
+        ("2d.123@rmd.io", None),
+        ("2d0123456789x@rmd.io", None),
+        (".0123456789@rmd.io", "0123456789"),
+        ("0123456789@rmd.io", None),
+        ("2d.0123456789", None),
+    ],
+)
+def test_get_key_from_email_address(email, key):
+    assert tools.get_key_from_email_address(email) == key
+
+
+def test_dropped_mail_connection_is_closed(monkeypatch):
+    class DroppedSMTP:
+        def noop(self):
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+    class Backend:
+        closed = False
+
+        def __init__(self):
+            self.connection = DroppedSMTP()
+
+        def open(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(tools, "get_connection", Backend)
+    dropped = Backend()
+
+    connection = tools.get_open_mail_connection(dropped)
+
+    assert dropped.closed
+    assert connection is not dropped
+
+
+def test_sendmail_reconnects_dropped_mail_connection(monkeypatch):
+    sendmail = importlib.import_module("mails.management.commands.sendmail")
+    sent_with = []
+
+    def send_email_with_attachments(message, mail, text, connection=None):
+        sent_with.append(connection)
+        if len(sent_with) == 1:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+    class Backend:
+        closed = False
+
+        def __init__(self):
+            self.connection = None
+
+        def open(self):
+            self.connection = object()
+
+        def close(self):
+            self.closed = True
+            self.connection = None
+
+    monkeypatch.setattr(
+        sendmail, "send_email_with_attachments", send_email_with_attachments
+    )
+    monkeypatch.setattr(tools, "get_connection", Backend)
+    command = sendmail.Command()
+    dropped = command.mail_conn = tools.get_open_mail_connection(None)
+
+    command.send_due_mail(message=None, mail=None, text="")
+
+    assert dropped.closed
+    assert sent_with == [dropped, command.mail_conn]
+    assert command.mail_conn is not dropped
+
+
+def test_logged_recipient_does_not_open_mail_connection(db, mailoutbox, monkeypatch):
+    import_command = importlib.import_module("mails.management.commands.import")
+    AddressLog.objects.create(email="unknown@te.st", reason="NREG", attempt=1)
+
+    def get_connection():
+        raise AssertionError("Mail connection opened without sending")
+
+    monkeypatch.setattr(tools, "get_connection", get_connection)
+    connection = import_command.LazyMailConnection()
+    tools.send_registration_mail("unknown@te.st", connection=connection)
+    tools.send_wrong_recipient_mail("unknown@te.st", connection=connection)
+    connection.close()
+
+    assert not mailoutbox
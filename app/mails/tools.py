@@ -1,20 +1,61 @@
 import base64
 import datetime
 import logging
-import os
 import re
+import secrets
+import smtplib
+import string
 from hashlib import sha1
 
 import dateparser
+from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, Value, When
 from django.template.loader import get_template
 from django.utils import timezone
 from django.utils.encoding import smart_bytes
 
 logger = logging.getLogger("mails")
-host = re.sub("http(s)?://", "", settings.SITE_URL)
+host = settings.SITE_URL.split("://", 1)[-1]
+
+_KEY_CHARS = frozenset(string.ascii_lowercase + string.digits)
+_KEY_AND_DOMAIN_RE = re.compile(r"(\.[0-9a-z]{10})?@.*")
+_STRIP_RE = re.compile(
+    r"^(?:(?:%s)\s*)+"
+    % "|".join(re.escape(p) for p in settings.CALENDAR_STRIP_PREFIXES),
+    re.IGNORECASE,
+)
+
+_DELAY_UNITS = {"d": "days", "w": "weeks", "month": "months", "months": "months"}
+
+DEFAULT_BLOCK_DELAY = datetime.timedelta(7)
+
+
+def parse_delay(delay):
+    """Parses the delay part of an email address
+
+    Delays of the form <number><unit> as offered in MAILBOXES are computed
+    directly, everything else is left to dateparser, which is a lot slower.
+
+    :param  delay: the delay, e.g. "2w" or "3months"
+    :type   delay: string
+    :rtype: datetime or None
+    """
+    digits = len(delay) - len(delay.lstrip("0123456789"))
+    unit = _DELAY_UNITS.get(delay[digits:])
+    if not digits or unit is None:
+        return dateparser.parse(delay, settings=settings.DATEPARSER_SETTINGS)
+
+    # Like dateparser, keep the local wall clock time across DST changes
+    now = timezone.localtime().replace(tzinfo=None)
+    try:
+        offset = relativedelta(**{unit: int(delay[:digits])})
+        return timezone.make_aware(now + offset, is_dst=False)
+    except (OverflowError, ValueError):
+        return None
 
 
 def get_reminder_date_from_email_address(email_address):
@@ -24,15 +65,11 @@ def get_reminder_date_from_email_address(email_address):
     :type   email_address: string
     :rtype: datetime
     """
-    try:
-        date_part = re.sub(r"(\.[0-9a-z]{10})?@.*", "", email_address)
-        delay = dateparser.parse(date_part, settings=settings.DATEPARSER_SETTINGS)
-        days_until_reminder = (delay.date() - timezone.now().date()).days
-        if days_until_reminder < 0:
-            raise Exception("Invalid delay")
-        return delay
-    except:
+    date_part = _KEY_AND_DOMAIN_RE.sub("", email_address)
+    delay = parse_delay(date_part)
+    if delay is None or (delay.date() - timezone.now().date()).days < 0:
         raise Exception("Invalid delay")
+    return delay
 
 
 def get_delay_addresses_from_recipients(recipients):
@@ -42,20 +79,11 @@ def get_delay_addresses_from_recipients(recipients):
     :type   recipients: list
     :rtype: list
     """
-    delay_addresses = []
-    for recipient in recipients:
-        key = re.search(r"(\.[0-9a-z]{10})@", recipient["email"])
-        if key is None:
-            if dateparser.parse(
-                recipient["email"].split("@")[0], settings=settings.DATEPARSER_SETTINGS
-            ):
-                delay_addresses.append(recipient["email"])
-        else:
-            email_without_key = recipient["email"].replace(key.group(1), "")
-            if dateparser.parse(
-                email_without_key.split("@")[0], settings=settings.DATEPARSER_SETTINGS
-            ):
-                delay_addresses.append(recipient["email"])
+    delay_addresses = [
+        recipient["email"]
+        for recipient in recipients
+        if parse_delay(_KEY_AND_DOMAIN_RE.sub("", recipient["email"]))
+    ]
     if delay_addresses:
         return delay_addresses
     else:
@@ -69,23 +97,33 @@ def get_key_from_email_address(email_address):
     :type   email_address: string
     :rtype: string
     """
-    try:
-        return re.search(r"\.([0-9a-z]{10})@", email_address).group(1)
-    except AttributeError:
+    # Plain string checks for ".<key>@" instead of a regex search
+    at = email_address.find("@")
+    start = at - 10
+    key = email_address[start:at]
+    if start < 1 or email_address[start - 1] != "." or not _KEY_CHARS.issuperset(key):
         return None
+    return key
 
 
-def send_registration_mail(recipient):
+def send_registration_mail(recipient, connection=None):
     """Sends an error mail to not registred users and logs it
 
-    :param  recipient: the email address of the recipient
-    :type   recipient: string
+    :param  recipient:  the email address of the recipient
+    :type   recipient:  string
+    :param  connection: the mail connection to send through
+    :type   connection: django.core.mail.backends.base.BaseEmailBackend
     """
     from mails.models import AddressLog
 
-    try:
-        AddressLog.objects.get(email=recipient, reason="NREG")
-    except:
+    # A failed send rolls the log entry back, so the mail is retried later
+    with transaction.atomic():
+        log_entry, created = AddressLog.objects.get_or_create(
+            email=recipient, reason="NREG", defaults={"attempt": 1}
+        )
+        if not created:
+            return
+
         tpl = get_template("mails/messages/not_registered_mail.txt")
 
         subject = "Register at %s!" % host
@@ -93,41 +131,50 @@ def send_registration_mail(recipient):
             {"recipient": recipient, "url": settings.SITE_URL, "host": host}
         )
 
-        msg = EmailMessage(subject, content, settings.EMAIL_HOST_USER, [recipient])
+        msg = EmailMessage(
+            subject,
+            content,
+            settings.EMAIL_HOST_USER,
+            [recipient],
+            connection=connection,
+        )
 
         msg.send()
 
-        log_entry = AddressLog(email=recipient, reason="NREG", attempt=1)
-        log_entry.save()
-
 
-def send_wrong_recipient_mail(recipient):
+def send_wrong_recipient_mail(recipient, connection=None):
     """Sends an error mail to not registred users
 
-    :param  recipient: the email address of the recipient
-    :type   recipient: string
+    :param  recipient:  the email address of the recipient
+    :type   recipient:  string
+    :param  connection: the mail connection to send through
+    :type   connection: django.core.mail.backends.base.BaseEmailBackend
     """
     from mails.models import AddressLog
 
-    try:
-        AddressLog.objects.get(email=recipient)
-    except:
-        tpl = get_template("mails/messages/wrong_recipient_mail.txt")
+    if AddressLog.objects.filter(email=recipient).exists():
+        return
 
-        subject = "Your mail on %s was deleted!" % host
-        content = tpl.render({"recipient": recipient, "host": host})
-        msg = EmailMessage(subject, content, settings.EMAIL_HOST_USER, [recipient])
+    tpl = get_template("mails/messages/wrong_recipient_mail.txt")
 
-        msg.send()
+    subject = "Your mail on %s was deleted!" % host
+    content = tpl.render({"recipient": recipient, "host": host})
+    msg = EmailMessage(
+        subject, content, settings.EMAIL_HOST_USER, [recipient], connection=connection
+    )
 
+    msg.send()
 
-def send_activation_mail(key, recipient):
+
+def send_activation_mail(key, recipient, connection=None):
     """Sends an activation mail for additional addresses
 
-    :param  key:       the activation key
-    :type   key:       string
-    :param  recipient: the email address of the recipient
-    :type   recipient: string
+    :param  key:        the activation key
+    :type   key:        string
+    :param  recipient:  the email address of the recipient
+    :type   recipient:  string
+    :param  connection: the mail connection to send through
+    :type   connection: django.core.mail.backends.base.BaseEmailBackend
     """
     from mails.models import AddressLog
 
@@ -135,44 +182,42 @@ def send_activation_mail(key, recipient):
     tpl = get_template("mails/messages/activation_mail.txt")
     content = tpl.render({"recipient": recipient, "key": key, "host": host})
 
-    msg = EmailMessage(subject, content, settings.EMAIL_HOST_USER, [recipient])
+    msg = EmailMessage(
+        subject, content, settings.EMAIL_HOST_USER, [recipient], connection=connection
+    )
 
-    try:
-        log_entry = AddressLog.objects.get(email=recipient, reason="SPAM")
+    # A failed send rolls the attempt back, so it does not block the address
+    with transaction.atomic():
+        now = timezone.now()
+        updated = AddressLog.objects.filter(
+            email=recipient, reason="SPAM", date__gte=now, attempt__lte=5
+        ).update(attempt=F("attempt") + 1, date=get_next_block_date(now))
 
-        if log_entry.date < timezone.now() or log_entry.attempt > 5:
-            logger.warning(
-                "No registration email was sent. %s is blocked" % (recipient)
+        if not updated:
+            log_entry, created = AddressLog.objects.get_or_create(
+                email=recipient, reason="SPAM", defaults={"attempt": 0}
             )
-            return
-
-        else:
-
-            log_entry.attempt += 1
-            log_entry.date = timezone.now() + get_block_delay(log_entry.attempt)
-            log_entry.save()
+            if not created:
+                logger.warning(
+                    "No registration email was sent. %s is blocked" % (recipient)
+                )
+                return
 
         msg.send()
 
-    except:
-        msg.send()
-
-        log_entry = AddressLog(
-            email=recipient, reason="SPAM", attempt=0, date=timezone.now()
-        )
-        log_entry.save()
-
 
-def send_connection_mail(key, recipient, account):
+def send_connection_mail(key, recipient, account, connection=None):
     """Sends a mail which confirms the connection of
     an existing user to another existing account
 
-    :param  key:       the activation key (urlsafe b64 of username)
-    :type   key:       string
-    :param  recipient: the email address of the recipient
-    :type   recipient: string
-    :param  account    the account which it should be connected to
-    :type   account    mails.models.Account
+    :param  key:        the activation key (urlsafe b64 of username)
+    :type   key:        string
+    :param  recipient:  the email address of the recipient
+    :type   recipient:  string
+    :param  account     the account which it should be connected to
+    :type   account     mails.models.Account
+    :param  connection: the mail connection to send through
+    :type   connection: django.core.mail.backends.base.BaseEmailBackend
     """
     from mails.models import AddressLog
 
@@ -182,39 +227,74 @@ def send_connection_mail(key, recipient, account):
         {"recipient": recipient, "account_id": account.id, "key": key, "host": host}
     )
 
-    msg = EmailMessage(subject, content, settings.EMAIL_HOST_USER, [recipient])
-
-    try:
-        log_entry = AddressLog.objects.get(email=recipient, reason="SPAM")
-
-        if log_entry.date < timezone.now() or log_entry.attempt > 5:
-            logger.warning("No connection email was sent. %s is blocked" % (recipient))
-            return
-
-        else:
+    msg = EmailMessage(
+        subject, content, settings.EMAIL_HOST_USER, [recipient], connection=connection
+    )
 
-            log_entry.attempt += 1
-            log_entry.date = timezone.now() + get_block_delay(log_entry.attempt)
-            log_entry.save()
+    # A failed send rolls the attempt back, so it does not block the address
+    with transaction.atomic():
+        now = timezone.now()
+        updated = AddressLog.objects.filter(
+            email=recipient, reason="SPAM", date__gte=now, attempt__lte=5
+        ).update(attempt=F("attempt") + 1, date=get_next_block_date(now))
 
-        msg.send()
+        if not updated:
+            log_entry, created = AddressLog.objects.get_or_create(
+                email=recipient, reason="SPAM", defaults={"attempt": 0}
+            )
+            if not created:
+                logger.warning(
+                    "No connection email was sent. %s is blocked" % (recipient)
+                )
+                return
 
-    except:
         msg.send()
 
-        log_entry = AddressLog(
-            email=recipient, reason="SPAM", attempt=0, date=timezone.now()
-        )
-        log_entry.save()
-
 
-def get_block_delay(attempt):
-    """Gets the block delay by attempt
+def get_open_mail_connection(connection):
+    """Returns an open mail connection, reconnecting if the server dropped it
 
-    :param  attempt: the attempt to get the delay for
-    :type   attempt: integer
+    :param  connection: the previously used connection or None
+    :type   connection: django.core.mail.backends.base.BaseEmailBackend
+    :rtype: django.core.mail.backends.base.BaseEmailBackend
+    """
+    smtp = getattr(connection, "connection", None)
+    if smtp is not None:
+        try:
+            smtp.noop()
+            return connection
+        except (smtplib.SMTPException, OSError):
+            logger.info("Mail connection was dropped, reconnecting")
+            try:
+                connection.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+    elif connection is not None and not hasattr(connection, "connection"):
+        # Backends without a socket (locmem, console...) never go stale
+        return connection
+
+    connection = get_connection()
+    connection.open()
+    return connection
+
+
+def get_next_block_date(now):
+    """Gets the block date of the next attempt as a database expression
+
+    Lets the date be set in the same UPDATE which increments the attempt.
+
+    :param  now: the current time
+    :type   now: datetime.datetime
+    :rtype: django.db.models.Case
     """
-    return settings.BLOCK_DELAYS.get(attempt, datetime.timedelta(7))
+    return Case(
+        *[
+            When(attempt=attempt - 1, then=Value(now + delay))
+            for attempt, delay in settings.BLOCK_DELAYS.items()
+        ],
+        default=Value(now + DEFAULT_BLOCK_DELAY),
+        output_field=DateTimeField(),
+    )
 
 
 def get_all_users_of_account(user):
@@ -224,8 +304,10 @@ def get_all_users_of_account(user):
     :type   user: models.User
     :rtype: list
     """
-    return User.objects.filter(userprofile__account=user.get_account()).order_by(
-        "-last_login"
+    return (
+        User.objects.filter(userprofile__account__userprofile__user=user)
+        .select_related("userprofile__account")
+        .order_by("-last_login")
     )
 
 
@@ -238,11 +320,7 @@ def calendar_clean_subject(subj):
     :type   subj: string
     :rtype: string
     """
-    strip_re = "(%s)" % ")|(".join(settings.CALENDAR_STRIP_PREFIXES)
-    after = re.sub(strip_re, "", subj)
-    if after == subj:
-        return after
-    return calendar_clean_subject(after)
+    return _STRIP_RE.sub("", subj)
 
 
 def create_additional_user(email, user):
@@ -253,13 +331,16 @@ def create_additional_user(email, user):
     :param  user:    the user which wants to create a new user
     :type   email:   django.contrib.auth.models.User
     """
-    from mails.models import AddressLog, UserProfile
+    from mails.models import UserProfile
 
+    username = (
+        base64.urlsafe_b64encode(sha1(smart_bytes(email)).digest())
+        .decode("utf-8")
+        .rstrip("=")
+    )
     new_user = User(
         email=email,
-        username=base64.urlsafe_b64encode(sha1(smart_bytes(email)).digest())
-        .decode("utf-8")
-        .rstrip("="),
+        username=username,
         date_joined=timezone.now(),
         password=user.password,
         is_active=False,
@@ -271,13 +352,9 @@ def create_additional_user(email, user):
 
     user_profile.save()
 
-    try:
-        user_log_entry = AddressLog.objects.filter(email=user.email)
-        user_log_entry.delete()
-    except:
-        pass
+    delete_log_entries(user.email)
 
-    key = base64.urlsafe_b64encode(new_user.username.encode("utf-8")).decode("utf-8")
+    key = base64.urlsafe_b64encode(username.encode("utf-8")).decode("utf-8")
     send_activation_mail(recipient=email, key=key)
 
 
@@ -289,11 +366,7 @@ def delete_log_entries(email):
     """
     from mails.models import AddressLog
 
-    try:
-        user_log_entry = AddressLog.objects.filter(email=email)
-        user_log_entry.delete()
-    except:
-        pass
+    AddressLog.objects.filter(email=email).delete()
 
 
 def generate_key():
@@ -301,4 +374,4 @@ def generate_key():
 
     :rtype: string
     """
-    return base64.b32encode(os.urandom(7))[:10].lower().decode("utf-8")
+    return secrets.token_hex(5)
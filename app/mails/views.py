@@ -10,7 +10,7 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
 from django.core.mail import send_mail
-from django.db.models import Count
+from django.db.models import Count, F, Min
 from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.decorators import method_decorator
@@ -149,7 +149,13 @@ class MailView(generic.ListView):
     def get_queryset(self):
         if self.request.user.is_authenticated:
             mails = Mail.my_mails(self.request.user)
-            return sorted(mails, key=lambda m: (m.next_due() is None, m.next_due()))
+            return (
+                mails.select_related("user")
+                .only("subject", "sent", "user__email")
+                .prefetch_related("recipient_set", "dues")
+                .annotate(next_due_date=Min("dues__due"))
+                .order_by(F("next_due_date").asc(nulls_last=True))
+            )
 
     @method_decorator(login_required)
     def dispatch(self, *args, **kwargs):
@@ -158,18 +164,25 @@ class MailView(generic.ListView):
 
 @login_required(login_url="/login/")
 def mail_info_view(request, id):
-    mail = get_object_or_404(Mail.my_mails(request.user), pk=id)
+    mails = (
+        Mail.my_mails(request.user)
+        .select_related("user")
+        .prefetch_related("dues", "recipient_set")
+    )
+    mail = get_object_or_404(mails, pk=id)
     return render(request, "mails/mail_info.html", {"mail": mail})
 
 
+@login_required(login_url="/login/")
 def mail_edit_view(request, id):
-    dues = Due.objects.filter(mail__id=id)
-    return render(request, "mails/mail_edit.html", {"dues": dues, "mail_id": id})
+    mail = get_object_or_404(Mail.my_mails(request.user), pk=id)
+    dues = mail.dues.all()
+    return render(request, "mails/mail_edit.html", {"dues": dues, "mail_id": mail.id})
 
 
+@login_required(login_url="/login/")
 def mail_update_view(request):
     mail = get_object_or_404(Mail.my_mails(request.user), pk=request.POST["mail_id"])
-    saved_dues = Due.objects.filter(mail=mail).values_list("id", flat=True)
     edited_dues = []
 
     dues = request.POST.lists()
@@ -196,10 +209,7 @@ def mail_update_view(request):
             d.save()
             edited_dues.append(due_id)
 
-    for saved_due in saved_dues:
-        if saved_due not in edited_dues:
-            d = Due.objects.get(mail=mail, pk=saved_due)
-            d.delete()
+    mail.dues.exclude(id__in=edited_dues).delete()
 
     return HttpResponseRedirect("/mails/")
 
@@ -215,10 +225,8 @@ def mail_delete_view(request):
     mail_id = request.POST.get("id")
     mail = get_object_or_404(Mail.my_mails(request.user), pk=mail_id)
 
-    imap_conn = imaphelper.get_connection()
-    imap_mail = imaphelper.IMAPMessage.from_dbid(mail_id, imap_conn)
+    imaphelper.with_shared_connection(imaphelper.delete_by_dbids, [mail.id])
     mail.delete()
-    imap_mail.delete()
 
     return HttpResponseRedirect("/")
 
@@ -226,20 +234,20 @@ def mail_delete_view(request):
 def download_calendar_view(request, secret):
     username = base64.urlsafe_b64decode(secret).decode("utf-8")
     user = User.objects.get(username=username)
-    dues = Due.objects.filter(mail__in=Mail.my_mails(user))
+    mails = Mail.my_mails(user).prefetch_related("dues")
     cal = Calendar()
     cal.add("prodid", "-//rmd.io Events Calendar//%s//EN" % settings.SITE_URL)
     cal.add("version", "2.0")
 
-    for due in dues:
-        event = Event()
-        event.add(
-            "summary", "%s [rmd.io]" % tools.calendar_clean_subject(due.mail.subject)
-        )
-        event.add("description", "%s/mails/" % settings.SITE_URL)
-        event.add("dtstart", due.due)
-        event.add("dtend", due.due)
-        cal.add_component(event)
+    for mail in mails:
+        summary = "%s [rmd.io]" % tools.calendar_clean_subject(mail.subject)
+        for due in mail.dues.all():
+            event = Event()
+            event.add("summary", summary)
+            event.add("description", "%s/mails/" % settings.SITE_URL)
+            event.add("dtstart", due.due)
+            event.add("dtend", due.due)
+            cal.add_component(event)
 
     response = HttpResponse(content=cal.to_ical(), content_type="text/calendar")
     response["Content-Disposition"] = "attachment; filename=maildelay.ics"
@@ -281,7 +289,7 @@ def download_vcard_view(request):
 @login_required(login_url="/login/")
 def user_activate_view(request, key):
     try:
-        username = base64.urlsafe_b64decode(key)
+        username = base64.urlsafe_b64decode(key).decode("utf-8")
         user = User.objects.get(username=username)
         user.is_active = True
         user.save()